@@ -1,9 +1,19 @@
 import argparse
 import os
-from PIL import Image, ImageSequence
+from concurrent.futures import ProcessPoolExecutor
+from queue import Full, Queue
+from threading import Event, Thread
+from PIL import GifImagePlugin, Image, ImageSequence
 import numpy as np
+from numba import config, njit, prange, set_num_threads
 from tqdm import tqdm
 
+# Keep GIF frames in palette mode while they share the first frame's palette, so they can be
+# processed through their palette instead of pixel by pixel
+GifImagePlugin.LOADING_STRATEGY = (
+    GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+)
+
 
 def hex_to_rgb(hex_color):
     """
@@ -27,11 +37,225 @@ def hex_to_rgb(hex_color):
         hex_color = hex_color * 2
     elif len(hex_color) != 6:
         raise ValueError(f"Invalid HEX color: {hex_color}")
-    return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
+    value = int.from_bytes(bytes.fromhex(hex_color), "big")
+    return (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF
+
+
+@njit(inline="always")
+def _matches(r, g, b, tr, tg, tb, tol, sphere):
+    """
+    Checks whether a pixel is within the tolerance range of the target color.
+
+    Arguments:
+        r, g, b (int): The pixel color.
+        tr, tg, tb (int): The color to replace.
+        tol (int): Tolerance for color replacement.
+        sphere (bool): Match by squared distance instead of per-channel difference.
+
+    Returns:
+        bool: True if the pixel should be replaced.
+
+    Description:
+        In sphere mode a pixel matches if its squared distance to the target color is at most
+        3 * tol^2, i.e. the sphere that passes through the corners of the tolerance cube.
+    """
+    if sphere:
+        # Pixel matches if it lies within the tolerance sphere
+        dr = np.int32(r) - tr
+        dg = np.int32(g) - tg
+        db = np.int32(b) - tb
+        return dr * dr + dg * dg + db * db <= 3 * tol * tol
+    # Pixel matches if every channel is within the tolerance range
+    return (abs(r - tr) <= tol) & (abs(g - tg) <= tol) & (abs(b - tb) <= tol)
+
+
+@njit(cache=True)
+def _has_match(arr, tr, tg, tb, tol, sphere):
+    """
+    Checks whether any pixel of the frame is within the tolerance range.
+
+    Arguments:
+        arr (numpy.ndarray): Frame as a uint8 array of shape (H, W, 3) or (H, W, 4).
+        tr, tg, tb (int): The color to replace.
+        tol (int): Tolerance for color replacement.
+        sphere (bool): Match by squared distance instead of per-channel difference.
+
+    Returns:
+        bool: True if at least one pixel would be replaced.
+    """
+    height, width = arr.shape[0], arr.shape[1]
+    for y in range(height):
+        for x in range(width):
+            if _matches(
+                arr[y, x, 0], arr[y, x, 1], arr[y, x, 2], tr, tg, tb, tol, sphere
+            ):
+                return True
+    return False
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _replace(arr, tr, tg, tb, nr, ng, nb, tol, sphere):
+    """
+    Replaces pixels within the tolerance range in place, in a single pass over the frame.
+
+    Arguments:
+        arr (numpy.ndarray): Frame as a uint8 array of shape (H, W, 3) or (H, W, 4).
+        tr, tg, tb (int): The color to replace.
+        nr, ng, nb (int): The new color.
+        tol (int): Tolerance for color replacement.
+        sphere (bool): Match by squared distance instead of per-channel difference.
+
+    Description:
+        Only the RGB channels are written, so the alpha channel (if any) is left untouched.
+    """
+    height, width = arr.shape[0], arr.shape[1]
+    for y in prange(height):
+        for x in range(width):
+            r = arr[y, x, 0]
+            g = arr[y, x, 1]
+            b = arr[y, x, 2]
+            hit = _matches(r, g, b, tr, tg, tb, tol, sphere)
+            arr[y, x, 0] = nr if hit else r
+            arr[y, x, 1] = ng if hit else g
+            arr[y, x, 2] = nb if hit else b
+
+
+def decoded_frames(img, mode, depth=2):
+    """
+    Decodes the frames of a GIF animation in a background thread.
+
+    Arguments:
+        img (PIL.Image.Image): The opened GIF animation. It must not be used while frames are read.
+        mode (str): Mode to convert frames that are not palette frames to, "RGB" or "RGBA".
+        depth (int, optional): Number of decoded frames to keep ready (default: 2).
+
+    Yields:
+        PIL.Image.Image: A copy of the frame, in "P" mode or in the given mode.
+
+    Description:
+        Pillow releases the GIL while decoding and converting, so the next frame is decoded while
+        the current one is processed.
+    """
+    frames = Queue(maxsize=depth)
+    stop = Event()
+
+    def put(item):
+        # Give up once the consumer has stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def decode():
+        try:
+            for frame in ImageSequence.Iterator(img):
+                if stop.is_set():
+                    return
+                # Copy palette frames, since changing the original's palette affects later frames
+                put(frame.copy() if frame.mode == "P" else frame.convert(mode))
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    thread = Thread(target=decode, daemon=True)
+    thread.start()
+    try:
+        while (frame := frames.get()) is not None:
+            if isinstance(frame, Exception):
+                raise frame
+            yield frame
+    finally:
+        # Stop the decoder and wait for it, so it doesn't touch the image after it is closed
+        stop.set()
+        while not frames.empty():
+            frames.get_nowait()
+        thread.join()
+
+
+def processed_frames(frames, mode, match_args, replace_args):
+    """
+    Replaces the color in each frame, one frame at a time.
+
+    Arguments:
+        frames (iterable): Frames returned by decoded_frames.
+        mode (str): Mode of the frames that are not palette frames, "RGB" or "RGBA".
+        match_args (tuple): Target color, tolerance and tolerance mode passed to _has_match.
+        replace_args (tuple): Colors, tolerance and tolerance mode passed to _replace.
+
+    Yields:
+        PIL.Image.Image: The processed frame.
+
+    Description:
+        Only the frame being processed is kept in memory, so the whole animation never has to be
+        held as a list of decoded frames. The yielded frames share one buffer, so each frame is
+        only valid until the next one is requested. Palette frames are processed by replacing the
+        color in their palette (at most 256 entries) instead of in every pixel.
+    """
+    buffer = None
+    for frame in frames:
+        if frame.mode == "P":
+            palette = np.array(frame.getpalette(), dtype=np.uint8).reshape(1, -1, 3)
+            # If no palette color is within the tolerance range, no pixel of the frame is either
+            if _has_match(palette, *match_args):
+                _replace(palette, *replace_args)
+                frame.putpalette(palette.tobytes())
+            yield frame
+            continue
+
+        # Pillow still copies the frame via tobytes(), but unlike np.array, np.asarray
+        # doesn't copy it a second time
+        view = np.asarray(frame)
+
+        if not _has_match(view, *match_args):
+            # Nothing to replace, so the frame is passed through without copying it into the buffer
+            yield frame
+            continue
+
+        # Copy every frame into the same buffer instead of allocating a new array
+        if buffer is None or buffer.shape[:2] != (frame.height, frame.width):
+            buffer = np.empty((frame.height, frame.width, len(mode)), dtype=np.uint8)
+        buffer[...] = view
+
+        # Replace color with the new one (RGB), alpha channel remains unchanged if present
+        _replace(buffer, *replace_args)
+
+        # Wrap the buffer as an Image object; the GIF writer copies each frame before
+        # requesting the next one, so the buffer can be reused for the next frame
+        yield Image.frombuffer(mode, frame.size, buffer, "raw", mode, 0, 1)
+
+
+def quantized_frames(frames):
+    """
+    Converts RGB frames to palette frames using the fast octree method.
+
+    Arguments:
+        frames (iterable): Frames without transparency, in "RGB" or "P" mode.
+
+    Yields:
+        PIL.Image.Image: The frame in "P" mode.
+
+    Description:
+        Each RGB frame gets its own 256-color palette, which is much cheaper to compute than the
+        median cut the GIF writer would otherwise run on it. Palette frames are passed through.
+    """
+    for frame in frames:
+        if frame.mode == "RGB":
+            frame = frame.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        yield frame
 
 
 def replace_color_with_tolerance(
-    input_path, output_path, target_color, replacement_color, tolerance=30, duration=100
+    input_path,
+    output_path,
+    target_color,
+    replacement_color,
+    tolerance=30,
+    duration=100,
+    tolerance_mode="cube",
+    position=0,
 ):
     """
     Replaces the specified color (within the tolerance range) with another in a GIF animation.
@@ -43,6 +267,10 @@ def replace_color_with_tolerance(
         replacement_color (tuple): The new color to replace the target color, in the format (R, G, B).
         tolerance (int, optional): Tolerance for color replacement (default: 30).
         duration (int, optional): Frame duration in milliseconds (default: 100).
+        tolerance_mode (str, optional): "cube" to compare each channel separately or "sphere"
+            to compare the squared distance between colors (default: "cube").
+        position (int, optional): Line of the progress bar when several files are processed at once
+            (default: 0).
 
     Description:
         This function processes all frames of the GIF animation, replaces the target color within the tolerance
@@ -50,66 +278,67 @@ def replace_color_with_tolerance(
     """
     # Check if the output directory exists, if not, create it
     output_dir = os.path.dirname(output_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
 
     with Image.open(input_path) as img:
-        frames = []
-        total_frames = sum(
-            1 for _ in ImageSequence.Iterator(img)
-        )  # Count the number of frames
-
-        print(f"Processing file {input_path}...")
-        for frame in tqdm(
-            ImageSequence.Iterator(img),
-            total=total_frames,
-            desc=f"Processing {os.path.basename(input_path)}",
-        ):
-            frame = frame.convert("RGBA")
-            array = np.array(frame)  # Convert frame to NumPy array
-
-            # Mask for pixels within the tolerance range
-            mask = np.all(
-                np.abs(array[:, :, :3] - np.array(target_color)) <= tolerance, axis=-1
-            )
-
-            # Copy the alpha channel separately
-            alpha_channel = array[:, :, 3]
-
-            # Replace color with the new one (RGB), alpha channel remains unchanged
-            array[mask] = [
-                *replacement_color,
-                255,
-            ]  # Set new color and full opacity (255)
+        # Frames without transparency don't need an alpha channel
+        if img.info.get("transparency") is None and img.mode != "RGBA":
+            mode = "RGB"
+        else:
+            mode = "RGBA"
 
-            # Restore the alpha channel
-            array[:, :, 3] = alpha_channel
+        total_frames = getattr(img, "n_frames", None)  # Number of frames, if known
 
-            # Convert back to Image object
-            frames.append(Image.fromarray(array, "RGBA"))
+        # Kernel arguments are the same for every frame, so build them once
+        sphere = tolerance_mode == "sphere"
+        match_args = (*target_color, tolerance, sphere)
+        replace_args = (*target_color, *replacement_color, tolerance, sphere)
 
         # Check the output file extension
         if not output_path.lower().endswith(".gif"):
             output_path += ".gif"
 
+        print(f"Processing file {input_path}...")
         print(f"Saving result to {output_path}...")
-        # Save all frames as a new GIF
-        frames[0].save(
-            output_path,
-            save_all=True,
-            append_images=frames[1:],
-            loop=0,
-            duration=duration,
+        # Frames are processed lazily while they are being written to the new GIF
+        decoded = decoded_frames(img, mode)
+        frames = processed_frames(
+            tqdm(
+                decoded,
+                total=total_frames,
+                desc=f"Processing {os.path.basename(input_path)}",
+                position=position,
+            ),
+            mode,
+            match_args,
+            replace_args,
         )
+        if mode == "RGB":
+            # Quantize frames here instead of letting the writer use median cut on each frame
+            frames = quantized_frames(frames)
+        try:
+            first_frame = next(frames)
+            first_frame.save(
+                output_path,
+                save_all=True,
+                append_images=frames,
+                loop=0,
+                duration=duration,
+            )
+        finally:
+            # Stop decoding before the input file is closed, even if saving failed
+            decoded.close()
         print(f"File {output_path} successfully created!")
 
 
-def get_unique_filename(base_path):
+def get_unique_filename(base_path, reserved=()):
     """
     Generates a unique file name by adding a number if the file already exists.
 
     Arguments:
         base_path (str): The file path to check for uniqueness.
+        reserved (set, optional): Paths that are already taken even if they don't exist yet.
 
     Returns:
         str: A unique file name.
@@ -120,140 +349,197 @@ def get_unique_filename(base_path):
         ext = ".gif"
         base_path += ext
 
-    if not os.path.exists(base_path):
+    if not os.path.exists(base_path) and base_path not in reserved:
         return base_path
 
+    # List the directory once instead of checking every candidate name separately
+    directory, name = os.path.split(base)
+    try:
+        existing = {
+            os.path.normcase(entry.name) for entry in os.scandir(directory or ".")
+        }
+    except FileNotFoundError:
+        existing = set()
+
     counter = 1
     # Find a unique name by adding a counter
-    while os.path.exists(f"{base}_{counter}{ext}"):
+    while (
+        os.path.normcase(f"{name}_{counter}{ext}") in existing
+        or f"{base}_{counter}{ext}" in reserved
+    ):
         counter += 1
     return f"{base}_{counter}{ext}"
 
 
-# Command-line argument setup
-parser = argparse.ArgumentParser(
-    description="A script to replace a color in one or more GIF animations with tolerance."
-)
-parser.add_argument(
-    "-i",
-    "--input",
-    required=True,
-    nargs="+",
-    help="Path to one or more input GIF files (can specify multiple files separated by spaces)",
-)
-parser.add_argument(
-    "-o",
-    "--output",
-    help="Name of the output file (without path). If not specified, the input name is used with '_processed' appended.",
-)
-parser.add_argument(
-    "-od",
-    "--output-dir",
-    help="Directory to save the processed files. If not specified, files are saved in the same directory as the input.",
-)
-parser.add_argument(
-    "-oc",
-    "--old-color",
-    required=True,
-    help="The old color to replace, in R G B or HEX format (e.g., '51 204 204' or '#33CCCC')",
-)
-parser.add_argument(
-    "-nc",
-    "--new-color",
-    required=True,
-    help="The new color to replace the old color with, in R G B or HEX format (e.g., '201 59 187' or '#C93BBB')",
-)
-parser.add_argument(
-    "-t",
-    "--tolerance",
-    type=int,
-    default=30,
-    help="The tolerance for color replacement (default: 30)",
-)
-parser.add_argument(
-    "-d",
-    "--duration",
-    type=int,
-    default=100,
-    help="Time between frames in milliseconds (default: 100). It is not recommended to set it below 20",
-)
-parser.add_argument(
-    "-f",
-    "--force",
-    action="store_true",
-    help="Overwrite existing files without adding a number. Doesn't work with multiple input.",
-)
+def process_file(task):
+    """
+    Processes a single input file in a worker process.
 
-args = parser.parse_args()
+    Arguments:
+        task (tuple): Arguments for replace_color_with_tolerance.
+    """
+    replace_color_with_tolerance(*task)
+
+
+def main():
+    """
+    Parses the command-line arguments and processes every input file.
+    """
+    # Command-line argument setup
+    parser = argparse.ArgumentParser(
+        description="A script to replace a color in one or more GIF animations with tolerance."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        nargs="+",
+        help="Path to one or more input GIF files (can specify multiple files separated by spaces)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Name of the output file (without path). If not specified, the input name is used with '_processed' appended.",
+    )
+    parser.add_argument(
+        "-od",
+        "--output-dir",
+        help="Directory to save the processed files. If not specified, files are saved in the same directory as the input.",
+    )
+    parser.add_argument(
+        "-oc",
+        "--old-color",
+        required=True,
+        help="The old color to replace, in R G B or HEX format (e.g., '51 204 204' or '#33CCCC')",
+    )
+    parser.add_argument(
+        "-nc",
+        "--new-color",
+        required=True,
+        help="The new color to replace the old color with, in R G B or HEX format (e.g., '201 59 187' or '#C93BBB')",
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=int,
+        default=30,
+        help="The tolerance for color replacement (default: 30)",
+    )
+    parser.add_argument(
+        "-tm",
+        "--tolerance-mode",
+        choices=["cube", "sphere"],
+        default="cube",
+        help="How the tolerance is applied: 'cube' checks each channel separately, 'sphere' checks the distance between colors (default: cube)",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=int,
+        default=100,
+        help="Time between frames in milliseconds (default: 100). It is not recommended to set it below 20",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Overwrite existing files without adding a number. Doesn't work with multiple input.",
+    )
 
-# Check input files
-for input_file in args.input:
-    if not os.path.isfile(input_file):
-        print(f"File {input_file} not found. Please specify an existing file.")
+    args = parser.parse_args()
+
+    # Check input files
+    for input_file in args.input:
+        if not os.path.isfile(input_file):
+            print(f"File {input_file} not found. Please specify an existing file.")
+            exit(1)
+
+    # Define old and new colors
+    try:
+        if " " in args.old_color:  # If color is in R G B format
+            old_color = tuple(map(int, args.old_color.split()))
+        else:  # If color is in HEX format
+            old_color = hex_to_rgb(args.old_color)
+
+        if " " in args.new_color:  # If color is in R G B format
+            new_color = tuple(map(int, args.new_color.split()))
+        else:  # If color is in HEX format
+            new_color = hex_to_rgb(args.new_color)
+    except ValueError as e:
+        print(f"Error: {e}")
         exit(1)
 
-# Define old and new colors
-try:
-    if " " in args.old_color:  # If color is in R G B format
-        old_color = tuple(map(int, args.old_color.split()))
-    else:  # If color is in HEX format
-        old_color = hex_to_rgb(args.old_color)
-
-    if " " in args.new_color:  # If color is in R G B format
-        new_color = tuple(map(int, args.new_color.split()))
-    else:  # If color is in HEX format
-        new_color = hex_to_rgb(args.new_color)
-except ValueError as e:
-    print(f"Error: {e}")
-    exit(1)
-
-# Process each input file
-for input_file in args.input:
-    # Determine the output file path
-    if args.output:
-        if not args.output_dir:
-            # If the output parameter (-o) is specified and output_dir (-od) is not, save to the current directory
-            output_gif = args.output
-
-            if os.path.isabs(output_gif) or "\\" in output_gif or "/" in output_gif:
-                print(
-                    "Error: the '-o' parameter cannot contain a path. Specify only the file name."
-                )
-                exit(1)
+    # Determine the output file of each input file
+    tasks = []
+    reserved = set()
+    for input_file in args.input:
+        # Determine the output file path
+        if args.output:
+            if not args.output_dir:
+                # If the output parameter (-o) is specified and output_dir (-od) is not, save to the current directory
+                output_gif = args.output
+
+                if os.path.isabs(output_gif) or "\\" in output_gif or "/" in output_gif:
+                    print(
+                        "Error: the '-o' parameter cannot contain a path. Specify only the file name."
+                    )
+                    exit(1)
 
-            if os.path.exists(output_gif) and not args.force:
-                output_gif = get_unique_filename(output_gif)  # Generate a unique name
-            else:
                 output_gif = os.path.join(
                     os.getcwd(), output_gif
                 )  # Save in the current directory
-        else:
-            # If both parameters -o and -od are specified, save in the specified directory with the name from -o
-            output_gif = os.path.join(args.output_dir, args.output)
-
-            if os.path.exists(output_gif) and not args.force:
-                output_gif = get_unique_filename(
-                    os.path.join(args.output_dir, args.output)
+            else:
+                # If both parameters -o and -od are specified, save in the specified directory with the name from -o
+                output_gif = os.path.join(args.output_dir, args.output)
+        elif not args.output:
+            if args.output_dir:
+                # If the -od flag for the directory is specified and -o is not, save in the specified directory with _processed appended
+                output_gif = os.path.join(
+                    args.output_dir,
+                    os.path.basename(input_file).replace(".gif", "_processed.gif"),
                 )
-    elif not args.output:
-        if args.output_dir:
-            # If the -od flag for the directory is specified and -o is not, save in the specified directory with _processed appended
-            output_gif = os.path.join(
-                args.output_dir,
-                os.path.basename(input_file).replace(".gif", "_processed.gif"),
-            )
-            if os.path.exists(output_gif) and not args.force:
-                output_gif = get_unique_filename(output_gif)
-        else:
-            # If neither -o nor -od is specified, save in the current directory with _processed appended
-            output_gif = os.path.splitext(input_file)[0] + "_processed.gif"
-            if os.path.exists(output_gif) and not args.force:
-                output_gif = get_unique_filename(output_gif)
+            else:
+                # If neither -o nor -od is specified, save in the current directory with _processed appended
+                output_gif = os.path.splitext(input_file)[0] + "_processed.gif"
 
-    # Check if the file exists and the --force flag
-    if os.path.exists(output_gif) and not args.force:
-        output_gif = get_unique_filename(output_gif)  # Generate a unique name
+        # Check the output file extension
+        if not output_gif.lower().endswith(".gif"):
+            output_gif += ".gif"
+
+        # Check if the file exists and the --force flag; files are processed in
+        # parallel, so two inputs must not share an output file either
+        if output_gif in reserved or (not args.force and os.path.exists(output_gif)):
+            output_gif = get_unique_filename(
+                output_gif, reserved
+            )  # Generate a unique name
+        reserved.add(output_gif)
+
+        tasks.append(
+            (
+                input_file,
+                output_gif,
+                old_color,
+                new_color,
+                args.tolerance,
+                args.duration,
+                args.tolerance_mode,
+                len(tasks),
+            )
+        )
 
-    replace_color_with_tolerance(
-        input_file, output_gif, old_color, new_color, args.tolerance, args.duration
-    )
+    if len(tasks) == 1:
+        replace_color_with_tolerance(*tasks[0])
+    else:
+        # Each file is independent, so process them in separate processes and
+        # split the kernel threads between them to avoid oversubscribing the cores
+        workers = min(len(tasks), os.cpu_count() or 1)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_num_threads,
+            initargs=(max(1, config.NUMBA_NUM_THREADS // workers),),
+        ) as executor:
+            list(executor.map(process_file, tasks))
+
+
+if __name__ == "__main__":
+    main()